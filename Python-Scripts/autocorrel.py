@@ -4,8 +4,8 @@
 '''
  File Name: autocorrel.py
  Description: Autocorrelation Function and Correlogram plot.
- Observations: The pandas.core.datetools module is deprecated, but
- this won't give you a problem for the calculations here.
+ Observations: The ACF, its Bartlett confidence band and the decorrelation
+ time come from functions.py, which does the same for whole gridded fields.
  Author: Willy Hagi
  E-mail: hagi.willy@gmail.com
  Python Version: 3.6
@@ -18,20 +18,11 @@
 import numpy                    as np
 import matplotlib.pylab         as plt
 
-from statsmodels.tsa.stattools  import acf
+from functions                  import acf, acf_confint, decorrelation
 from scipy.signal               import detrend
 
 
 
-def dof(acfunc, confint, N):
-    # estimating the effective sample size of data with acf
-    lag  =  np.where(acfunc < conf[:,1])
-    lag  =  lag[0][0]
-    nef  =  N / lag
-    return nef
-
-
-
 
 
 ##----- reading and detrending (optional) data 
@@ -41,16 +32,17 @@ sst  =  np.loadtxt('nino3.asc')
 
 
 ##----- autocorrelation function and confidence intervals
-acf_total, conf  =  acf(sst, alpha=0.05, nlags=425, fft=True,
-                        unbiased=True)
-conf -= conf.mean(1)[:,None]  # lag 0 confidence intervals
+acf_total  =  acf(sst, nlags=425, unbiased=True)
+conf       =  acf_confint(acf_total, len(sst), alpha=0.05)
+conf       =  np.stack((-conf, conf), axis=1)  # lag 0 confidence intervals
 
 
 
 ##----- estimating the effective sample size
 n   = len(sst) / 12. # number of years
 print (n)
-df  =  dof(acf_total, conf, n )
+lag =  decorrelation(sst, nlags=425, alpha=0.05, unbiased=True)  # first lag inside the band
+df  =  n / lag
 print (df)
 
 
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+
+'''
+ File Name: climatology.py
+ Description: Out-of-core monthly climatology and anomalies of netcdf files.
+ Observations: Same selection and results as functions.Demean, but the file
+ is read in chunks of time steps, so fields larger than memory (e.g. 0.25 deg
+ monthly products) can be processed. A first pass keeps, for every calendar
+ month and grid point, the number of valid values, their running sum (for the
+ mean) and a Welford sum of squared deviations (for the standard deviation),
+ merged chunk by chunk with the update of Chan et al. (1979). A second pass
+ writes the anomalies and the standardized anomalies to a netcdf file.
+ Missing values are skipped as in xarray's groupby mean. The accumulators can
+ be saved next to the products, so each new month only costs its own read
+ (append) and a new base period only reads the months that enter or leave it
+ (rebase).
+ Author: Willy Hagi
+ E-mail: hagi.willy@gmail.com
+ Python Version: 3.7.3
+'''
+
+
+import os
+import tempfile
+import numpy               as np
+import xarray              as xr
+import netCDF4
+
+from functions             import Demean
+
+
+STATE_VERSION = 1
+
+
+
+
+
+##----------------------- CLASSES
+
+
+class StreamDemean(Demean):
+    '''
+    Demean for a variable 'var' of the netcdf file 'path', read 'chunk' time
+    steps at a time. average() and anomaly() give the results of Demean;
+    std() the monthly standard deviations and write() streams the anomalies
+    to disk.
+    '''
+    def __init__(self, path, var, lat1, lat2, lon1, lon2, time1, time2, chunk=120):
+        self.path  =  path
+        self.var   =  var
+        self.chunk =  chunk
+        self.dset  =  xr.open_dataset(path)
+        Demean.__init__(self, self.dset[var], lat1, lat2, lon1, lon2, time1, time2)
+
+
+    def _select(self, time1, time2):
+        # lazy selection, only read from disk chunk by chunk
+        return self.data.sel(time  =  slice(time1, time2),
+                             lat   =  slice(self.lat1, self.lat2),
+                             lon   =  slice(self.lon1, self.lon2))
+
+
+    def _chunks(self, x):
+        # (month, values) of consecutive blocks of time steps
+        months = x['time.month'].values
+        for i in range(0, x.sizes['time'], self.chunk):
+            sl = slice(i, i + self.chunk)
+            yield months[sl], np.asarray(x.isel(time=sl).values, dtype=float)
+
+
+    def accumulate(self):
+        '''
+        First pass: count, sum and Welford M2 of every calendar month and
+        grid point over the base period [time1, time2].
+        '''
+        self.x     =  self._select(self.time1, self.time2)
+        shape      =  (12,) + self.x.shape[1:]
+        self.count =  np.zeros(shape)
+        self.total =  np.zeros(shape)
+        self.m2    =  np.zeros(shape)
+        for months, values in self._chunks(self.x):
+            self.update(months, values)
+        self.last  =  self._select(None, None).indexes['time'][-1]  # last step of the file
+        return self
+
+
+    def update(self, months, values):
+        '''
+        Merges a block of values (time, ...) of the given calendar months into
+        the running statistics (Chan et al. 1979).
+        '''
+        for m in np.unique(months):
+            v      =  values[months == m]
+            valid  =  np.isfinite(v)
+            nb     =  valid.sum(axis=0)
+            sb     =  np.where(valid, v, 0.).sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mb  =  sb / nb
+                m2b =  np.where(valid, (v - mb) ** 2, 0.).sum(axis=0)
+                na  =  self.count[m - 1]
+                d   =  mb - self.total[m - 1] / na
+                m2  =  self.m2[m - 1] + m2b + d ** 2 * na * nb / (na + nb)
+            self.m2[m - 1]    =  np.where(na == 0, m2b, np.where(nb == 0, self.m2[m - 1], m2))
+            self.count[m - 1] =  na + nb
+            self.total[m - 1] += sb
+        self.__dict__.pop('xmean', None)
+
+
+    def downdate(self, months, values):
+        '''
+        Removes a block of values that was merged before (the reverse of the
+        update of Chan et al. 1979), e.g. months leaving the base period.
+        '''
+        for m in np.unique(months):
+            v      =  values[months == m]
+            valid  =  np.isfinite(v)
+            nb     =  valid.sum(axis=0)
+            sb     =  np.where(valid, v, 0.).sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mb  =  sb / nb
+                m2b =  np.where(valid, (v - mb) ** 2, 0.).sum(axis=0)
+                n   =  self.count[m - 1]
+                na  =  n - nb
+                d   =  mb - (self.total[m - 1] - sb) / na
+                m2  =  np.maximum(self.m2[m - 1] - m2b - d ** 2 * na * nb / n, 0.)
+            self.m2[m - 1]    =  np.where(na == 0, 0., np.where(nb == 0, self.m2[m - 1], m2))
+            self.count[m - 1] =  na
+            self.total[m - 1] =  np.where(na == 0, 0., self.total[m - 1] - sb)
+        self.__dict__.pop('xmean', None)
+
+
+    def _monthly(self, values, name):
+        coords = dict(month=np.arange(1, 13), lat=self.x['lat'], lon=self.x['lon'])
+        return xr.DataArray(values, coords=coords, dims=('month',) + self.x.dims[1:], name=name)
+
+
+    def average(self):
+        '''
+        Monthly gridded mean values, as Demean.average, in one pass of the
+        file.
+        '''
+        if not hasattr(self, 'count'):
+            self.accumulate()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.xmean = self._monthly(self.total / self.count, self.var)
+        return self.xmean
+
+
+    def std(self, ddof=0):
+        # monthly gridded standard deviation (ddof as in xarray's std)
+        if not hasattr(self, 'count'):
+            self.accumulate()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.sqrt(self.m2 / (self.count - ddof))
+        self.xstd = self._monthly(np.where(self.count > ddof, sd, np.nan), self.var)
+        return self.xstd
+
+
+    def anomaly(self):
+        # monthly gridded anomaly values, in memory as Demean.anomaly
+        if not hasattr(self, 'xmean'):
+            self.average()
+        self.anom = self.x.groupby('time.month') - self.xmean
+        return self.anom
+
+
+    def write(self, out, time1=None, time2=None, ddof=0):
+        '''
+        Second pass: streams the anomalies ('<var>_anom') and standardized
+        anomalies ('<var>_std') of [time1, time2] (default: from the start of
+        the base period to the end of the file) to the netcdf file 'out', one
+        chunk at a time.
+        '''
+        x      =  self._select(time1 or self.time1, time2)
+        with netCDF4.Dataset(out, 'w') as nc:
+            nc.createDimension('time', None)
+            for dim in x.dims[1:]:
+                nc.createDimension(dim, x.sizes[dim])
+                var = nc.createVariable(dim, x[dim].dtype, (dim,))
+                var.setncatts(x[dim].attrs)
+                var[:] = x[dim].values
+            raw    =  self._raw_time()
+            tvar   =  nc.createVariable('time', raw.dtype, ('time',))
+            tvar.setncatts(raw.attrs)
+
+            names  =  ('{}_anom'.format(self.var), '{}_std'.format(self.var))
+            dtype  =  np.result_type(self.data.dtype, np.float32)
+            outs   =  [nc.createVariable(name, dtype, x.dims, zlib=True, fill_value=dtype.type(np.nan))
+                       for name in names]
+            outs[0].setncatts(dict(self.data.attrs, long_name='monthly anomalies of ' + self.var))
+            outs[1].setncatts(dict(long_name='standardized monthly anomalies of ' + self.var, units='1'))
+            self._write_steps(nc, x, ddof)
+        return out
+
+
+    def _raw_time(self):
+        # time values as stored in the file (units and calendar untouched)
+        with xr.open_dataset(self.path, decode_times=False) as raw:
+            return raw['time'].load()
+
+
+    def _write_steps(self, nc, x, ddof):
+        # writes the anomalies of the time steps of x after the ones in nc
+        mean   =  self.average().values
+        sd     =  self.std(ddof).values
+        raw    =  self._raw_time()
+        tpos   =  self.dset.indexes['time'].get_indexer(x.indexes['time'])
+        i      =  len(nc.dimensions['time'])
+        nc['time'][i:i + len(tpos)] = raw.values[tpos]
+        outs   =  [nc['{}_anom'.format(self.var)], nc['{}_std'.format(self.var)]]
+        for months, values in self._chunks(x):
+            anom  =  values - mean[months - 1]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                outs[0][i:i + len(months)] = anom
+                outs[1][i:i + len(months)] = anom / sd[months - 1]
+            i += len(months)
+
+
+    ##----- incremental updates
+
+    def save(self, state):
+        '''
+        Writes the accumulators, the base period and the derived monthly mean
+        and standard deviation to the netcdf file 'state'. The file is written
+        next to its final name and renamed, so readers never see half of it.
+        '''
+        dims   =  ('month',) + self.x.dims[1:]
+        dset   =  xr.Dataset(dict(count=(dims, self.count), total=(dims, self.total), m2=(dims, self.m2),
+                                  mean=self.average(), std=self.std()),
+                             coords=self.xmean.coords)
+        dset.attrs.update(version=STATE_VERSION, path=os.path.abspath(self.path), var=self.var,
+                          lat1=self.lat1, lat2=self.lat2, lon1=self.lon1, lon2=self.lon2,
+                          time1=str(self.time1), time2=str(self.time2), chunk=self.chunk,
+                          last=str(np.datetime64(self.last, 'ns')))
+        fd, tmp =  tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(state)))
+        os.close(fd)
+        try:
+            dset.to_netcdf(tmp)
+            os.replace(tmp, state)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return state
+
+
+    @classmethod
+    def load(cls, state, path=None):
+        '''
+        StreamDemean from a state written by save(), for the file 'path'
+        (default: the one it was computed from) without reading it again.
+        '''
+        with xr.open_dataset(state) as dset:
+            dset  =  dset.load()
+        at    =  dset.attrs
+        if at.get('version') != STATE_VERSION:
+            raise ValueError('Climatology state {} has an unknown version'.format(state))
+        self  =  cls(path or at['path'], at['var'], at['lat1'], at['lat2'], at['lon1'], at['lon2'],
+                     at['time1'], at['time2'], int(at['chunk']))
+        self.x     =  self._select(self.time1, self.time2)
+        self.count =  dset['count'].values
+        self.total =  dset['total'].values
+        self.m2    =  dset['m2'].values
+        self.last  =  np.datetime64(at['last'])
+        return self
+
+
+    def _reopen(self):
+        # the file may have grown since it was opened
+        self.dset.close()
+        self.dset  =  xr.open_dataset(self.path, cache=False)
+        self.data  =  self.dset[self.var]
+        self.x     =  self._select(self.time1, self.time2)
+
+
+    def _steps(self, times):
+        # the selected area at the given time steps, read in chunks
+        x = self._select(None, None)
+        return x.isel(time=np.flatnonzero(x.indexes['time'].isin(times)))
+
+
+    def append(self, out=None, ddof=0):
+        '''
+        Adds the time steps of the file after the last one handled: those
+        inside the base period update the accumulators, and the steps after
+        the last one in the anomaly file 'out' (made by write), if given, are
+        appended to it. Only the new steps are read. If new steps fall inside
+        the base period, the anomalies already in 'out' were computed with the
+        previous climatology.
+        '''
+        self._reopen()
+        times  =  self._select(None, None).indexes['time']
+        new    =  times[times > self.last]
+        for months, values in self._chunks(self._steps(new.intersection(self.x.indexes['time']))):
+            self.update(months, values)
+        if len(new):
+            self.last  =  new[-1]
+        if out is not None:
+            with netCDF4.Dataset(out, 'a') as nc:
+                self._write_steps(nc, self._steps(self._unwritten(nc)), ddof)
+        return self
+
+
+    def _unwritten(self, nc):
+        # time steps of the file after the last one in the anomaly file nc,
+        # compared as stored (write copies the time units of the file)
+        times  =  self._select(None, None).indexes['time']
+        n      =  len(nc.dimensions['time'])
+        if n == 0:
+            return times
+        raw    =  self._raw_time().values
+        return times[raw[self.dset.indexes['time'].get_indexer(times)] > nc['time'][n - 1]]
+
+
+    def rebase(self, time1, time2):
+        '''
+        Moves the base period to [time1, time2], reading only the time steps
+        that leave it (removed with downdate) or enter it (merged with update).
+        '''
+        old    =  self.x.indexes['time']
+        self.time1, self.time2 = time1, time2
+        self.x =  self._select(time1, time2)
+        new    =  self.x.indexes['time']
+        for months, values in self._chunks(self._steps(old.difference(new))):
+            self.downdate(months, values)
+        for months, values in self._chunks(self._steps(new.difference(old))):
+            self.update(months, values)
+        return self
@@ -16,6 +16,7 @@ import proplot as plot
 import matplotlib.pyplot as plt
 
 from esmtools.stats import*
+from functions import Seasonal
 
 
 # --- read netcdf file
@@ -25,24 +26,15 @@ dset = xr.open_dataset('asstdt_pacific.nc')
 ''' the selection of the El Niño years are taken from here:
 	http://ggweather.com/enso/oni.htm '''
 
-# onset D(0) strong el niño years
-onset_elnino = [1957, 1965, 1972, 1987, 1991]
-# end JF(+1) strong el niño years
+# end JF(+1) strong el niño years (onset D(0) in 1957, 1965, 1972, 1987, 1991)
 end_elnino = [1958, 1966, 1973, 1988, 1992]
 
 
 # --- D(0)JF(+1) composites
-# all the december months
-dcb = dset['sst'].sel(time=np.in1d(dset['sst']['time.month'], [12]))
-# D(0)
-dcb0 = dcb.sel(time=np.in1d(dcb['time.year'], onset_elnino))
-# JF(+1)
-jf = dset['sst'].sel(time=np.in1d(dset['sst']['time.month'], [1, 2]))
-jf1 = jf.sel(time=np.in1d(jf['time.year'], end_elnino))
-# merge all months together
-djf = xr.merge([dcb0, jf1])
-# seasonal mean
-djf = djf.groupby('time.season').mean('time')
+# DJF means of every season-year, labelled by the year of JF(+1)
+djf = Seasonal(dset['sst'], 12, 1, 2).seasonal_mean()
+# composite of the el niño seasons
+djf = djf.sel(time=np.isin(djf['season_year'], end_elnino)).mean('time')
 print(djf)
 
 
@@ -55,7 +47,7 @@ ax.format(land=False, coast=True, innerborders=True, borders=True,
           latlim=(31, -31), lonlim=(119, 291),
           geogridlinewidth=0)
 
-map1 = ax.contourf(dset['lon'], dset['lat'], djf['sst'][0, :, :],
+map1 = ax.contourf(dset['lon'], dset['lat'], djf,
                    levels=np.arange(-1.5, 1.6, 0.1), cmap='Div', extend='both')
 
 ax.colorbar(map1, loc='b', shrink=0.5, extendrect=True)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+
+'''
+ File Name: eof_tools.py
+ Description: EOFs of fields that do not fit in memory.
+ Observations: Same results as functions.eof, but the (time, lat, lon) field is
+ read in slabs of grid points (e.g. from a lazily opened netcdf file), so only
+ one slab, the time x time Gram matrix (or a time x (neofs + 10) randomized
+ sketch) and the EOFs are in memory at once. The first pass accumulates the
+ Gram matrix or the sketch, the second projects the spatial patterns.
+ EofModel keeps the patterns in a small file to project new data on them, and
+ eof_bootstrap gives the sampling uncertainty of the modes.
+ Author: Willy Hagi
+ E-mail: hagi.willy@gmail.com
+ Python Version: 3.7.3
+'''
+
+
+import numpy               as np
+import xarray              as xr
+
+from multiprocessing       import shared_memory
+from functions             import eof, eof_norm, eff_sample, grid_slabs, PackedGrid
+from parallel              import run_batches, WORKER
+from field_significance    import block_indices, block_length
+
+
+
+
+
+##----------------------- SLABS
+
+
+def _slabs(data, weights, chunk, center):
+    # grid_slabs with the valid points weighted and centered, and the time
+    # mean of the unweighted slab
+    for sl, valid, x in grid_slabs(data, chunk):
+        mean   =  x.mean(axis=0).reshape((-1,) + tuple(data.shape[2:]))
+        if weights is not None:
+            x  =  x * weights[sl].reshape(-1)
+            valid &= np.isfinite(weights[sl].reshape(-1))
+        x      =  x[:, valid]
+        if center:
+            x  =  x - x.mean(axis=0)
+        yield sl, valid, x, mean
+
+
+
+
+
+##----------------------- STREAMING EOF
+
+
+def eof_stream(data, neofs=2, weights=None, method='auto', chunk=65536, center=True, normalize=False,
+               n_iter=4, seed=None, var=None, return_mean=False):
+    '''
+    EOFs of a (time, lat, lon) field read slab by slab: 'data' is a DataArray
+    (lazily opened), an array or memmap, or the path of a netcdf file with
+    the variable 'var'. 'chunk' is the number of grid points per slab, which
+    sets the peak memory with the time length. The methods are:
+
+      'gram'        accumulates the time x time Gram matrix (one pass), then
+                    projects the patterns (second pass)
+      'randomized'  accumulates a randomized sketch of the time space
+                    (Halko et al. 2011), with n_iter power iterations of one
+                    pass each, then one pass for the projection; for very
+                    long records, when the Gram matrix is too large
+
+    'auto' takes 'gram' up to 20000 time steps. The other options and the
+    returned EOF, PC, lmbd and variance fractions are the ones of
+    functions.eof. With return_mean=True the time mean of the unweighted
+    field (lat, lon) from the first pass is returned too.
+    '''
+    if isinstance(data, str):
+        data   =  xr.open_dataset(data)[var]
+    if isinstance(data, xr.DataArray):
+        data   =  data.transpose('time', ...)
+    T      =  data.shape[0]
+    shape  =  tuple(data.shape[1:])
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), shape)
+    if method == 'auto':
+        method = 'gram' if T <= 20000 else 'randomized'
+
+    def slabs():
+        return _slabs(data, weights, chunk, center)
+
+    # first pass: Gram matrix or randomized sketch of the time space
+    total  =  0.
+    mean   =  np.empty(shape)
+    if method == 'gram':
+        G      =  np.zeros((T, T))
+        for sl, _, x, m in slabs():
+            mean[sl] =  m
+            G     +=  x @ x.T
+            total +=  np.sum(x ** 2)
+        k      =  min(neofs, T)
+        lm, U  =  np.linalg.eigh(G)
+        U      =  U[:, ::-1][:, :k]
+        g      =  np.sqrt(np.maximum(lm[::-1][:k], 0.))
+    elif method == 'randomized':
+        l      =  neofs + 10
+        rng    =  np.random.default_rng(seed)
+        Y      =  np.zeros((T, l))
+        for sl, _, x, m in slabs():
+            mean[sl] =  m
+            Y     +=  x @ rng.standard_normal((x.shape[1], l))
+            total +=  np.sum(x ** 2)
+        for _ in range(n_iter):                     # power iterations, one pass each
+            U, _   =  np.linalg.qr(Y)
+            Y      =  np.zeros((T, l))
+            for _, _, x, _ in slabs():
+                Y +=  x @ (x.T @ U)
+        U, _   =  np.linalg.qr(Y)
+    else:
+        raise ValueError("method must be 'auto', 'gram' or 'randomized'")
+
+    # second pass: spatial patterns, B = U^T X slab by slab
+    B      =  np.full((U.shape[1], int(np.prod(shape))), np.nan)
+    index  =  np.arange(B.shape[1]).reshape(shape)
+    for sl, valid, x, _ in slabs():
+        B[:, index[sl].reshape(-1)[valid]] = U.T @ x
+    valid  =  np.all(np.isfinite(B), axis=0)
+
+    if method == 'gram':
+        V      =  B[:, valid] / np.where(g > 0, g, 1.)[:, np.newaxis]
+    else:
+        Ub, g, V = np.linalg.svd(B[:, valid], full_matrices=False)
+        k        = min(neofs, len(g))
+        U, g, V  = (U @ Ub)[:, :k], g[:k], V[:k]
+
+    sign   =  np.sign(V[np.arange(k), np.argmax(np.abs(V), axis=1)])
+    U, V   =  U * sign, V * sign[:, np.newaxis]
+    lmbd   =  g ** 2.
+    PC     =  U * g
+    if normalize:
+        PC, Vn =  eof_norm(PC, V.T, lmbd)
+        V      =  Vn.T
+    EOF    =  np.full((k, valid.size), np.nan)
+    EOF[:, valid] = V
+    if return_mean:
+        return EOF.reshape((k,) + shape), PC, lmbd, lmbd / total, mean
+    return EOF.reshape((k,) + shape), PC, lmbd, lmbd / total
+
+
+
+
+
+##----------------------- EOF MODEL
+
+
+MODEL_VERSION = 1
+
+
+class EofModel:
+    '''
+    EOF patterns with everything needed to project new data on them: the
+    time mean and weights used in the fit, the mask of valid points and the
+    eigenvalues lmbd for the eof_norm scaling. Saved as a compressed .npz
+    file, so monthly monitoring (e.g. AO-like indices) only projects the new
+    time steps instead of decomposing the whole record again.
+    '''
+    def __init__(self, eofs, lmbd, frac, mean, weights=None, pcs=None):
+        self.eofs    =  np.asarray(eofs, dtype=float)      # (neofs, lat, lon), unit norm
+        self.lmbd    =  np.asarray(lmbd, dtype=float)
+        self.frac    =  np.asarray(frac, dtype=float)
+        self.mean    =  np.asarray(mean, dtype=float)      # (lat, lon)
+        self.shape   =  self.eofs.shape[1:]
+        self.weights =  np.broadcast_to(np.ones(self.shape) if weights is None
+                                        else np.asarray(weights, dtype=float), self.shape).copy()
+        self.valid   =  np.all(np.isfinite(self.eofs), axis=0).reshape(-1)
+        self.V       =  self.eofs.reshape(len(self.lmbd), -1)[:, self.valid]
+        self.w       =  self.weights.reshape(-1)[self.valid]
+        self.m       =  self.mean.reshape(-1)[self.valid]
+        self.pcs     =  np.zeros((0, len(self.lmbd))) if pcs is None else np.asarray(pcs, dtype=float)
+
+
+    @classmethod
+    def fit(cls, data, neofs=2, weights=None, stream=False, chunk=65536, var=None, **kwargs):
+        '''
+        EOF model of a (time, lat, lon) field, the same inputs as eof_stream,
+        with functions.eof or, if stream=True, eof_stream (keyword arguments
+        go to the solver). The EOFs are kept unit-norm, so normalize is left
+        to project(). The PCs of the fit are kept as the first rows of the
+        record (unnormalized).
+        '''
+        if 'normalize' in kwargs:
+            raise ValueError('EofModel keeps unit-norm EOFs; use project(x, normalize) instead')
+        if isinstance(data, str):
+            data  =  xr.open_dataset(data)[var]
+        if isinstance(data, xr.DataArray):
+            data  =  data.transpose('time', ...)
+        if stream:
+            EOF, PC, lmbd, frac, mean = eof_stream(data, neofs, weights, chunk=chunk, return_mean=True,
+                                                   **kwargs)
+        else:
+            x     =  np.asarray(getattr(data, 'values', data), dtype=float)
+            EOF, PC, lmbd, frac = eof(x, neofs, weights, **kwargs)
+            mean  =  x.mean(axis=0)
+        return cls(EOF, lmbd, frac, mean, weights, PC)
+
+
+    def save(self, path):
+        # compact file with the patterns of the valid points only
+        np.savez_compressed(path, version=MODEL_VERSION, shape=self.shape, valid=self.valid,
+                            V=self.V, lmbd=self.lmbd, frac=self.frac, mean=self.m,
+                            weights=self.w, pcs=self.pcs)
+        return path
+
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            if int(f['version']) != MODEL_VERSION:
+                raise ValueError('EOF model {} has an unknown version'.format(path))
+            shape, valid = tuple(f['shape']), f['valid']
+            def grid(a, lead=()):
+                out = np.full(lead + (valid.size,), np.nan)
+                out[..., valid] = a
+                return out.reshape(lead + shape)
+            return cls(grid(f['V'], (len(f['lmbd']),)), f['lmbd'], f['frac'], grid(f['mean']),
+                       np.nan_to_num(grid(f['weights']), nan=1.), f['pcs'])
+
+
+    def project(self, x, normalize=True):
+        '''
+        PCs of new data x (..., lat, lon): any leading dimensions, e.g. (time,)
+        or (member, time) for a whole model ensemble, in one matrix product.
+        Missing values at valid points count as zero anomalies. With
+        normalize=True the PCs are divided by sqrt(lmbd) as in eof_norm.
+        '''
+        x      =  np.asarray(getattr(x, 'values', x), dtype=float)
+        lead   =  x.shape[:x.ndim - len(self.shape)]
+        a      =  (x.reshape(lead + (-1,))[..., self.valid] - self.m) * self.w
+        pc     =  np.nan_to_num(a) @ self.V.T
+        return pc / np.sqrt(self.lmbd) if normalize else pc
+
+
+    def append(self, x, chunk=None, normalize=True):
+        '''
+        Projects the new time steps of x (time, lat, lon), 'chunk' at a time
+        (e.g. from a lazily opened netcdf file), and appends them to the PC
+        record self.pcs. Returns the new PCs.
+        '''
+        chunk  =  chunk or len(x)
+        new    =  np.concatenate([self.project(x[i:i + chunk], normalize=False)
+                                  for i in range(0, len(x), chunk)])
+        self.pcs = np.concatenate((self.pcs, new))
+        return new / np.sqrt(self.lmbd) if normalize else new
+
+
+
+
+
+##----------------------- SAMPLING UNCERTAINTY
+
+
+def north_test(lmbd, n, frac=None):
+    '''
+    Rule of thumb of North et al. (1982): the sampling error of each
+    eigenvalue is lmbd * sqrt(2 / n), for n effective samples, and a mode
+    is separated if it is farther than that from its neighbours. Returns the
+    errors (scaled as 'frac' if given, like eofs' northTest(vfscaled=True))
+    and the separated flags.
+    '''
+    lmbd   =  np.asarray(lmbd, dtype=float)
+    err    =  lmbd * np.sqrt(2. / n)
+    gap    =  np.abs(np.diff(lmbd))
+    above  =  np.concatenate(([np.inf], gap))    # distance to the previous mode
+    below  =  np.concatenate((gap, [np.inf]))    # and to the next one
+    sep    =  (above > err) & (below > err)
+    if frac is not None:
+        err =  err * np.asarray(frac, dtype=float) / lmbd
+    return err, sep
+
+
+def congruence(a, b):
+    '''
+    Tucker's congruence coefficients sum(a b) / sqrt(sum(a^2) sum(b^2))
+    between every pattern of a (k, ...) and of b (m, ...), over the points
+    valid in both; a (k, m) matrix.
+    '''
+    a      =  np.asarray(a, dtype=float).reshape(len(a), -1)
+    b      =  np.asarray(b, dtype=float).reshape(len(b), -1)
+    valid  =  np.all(np.isfinite(a), axis=0) & np.all(np.isfinite(b), axis=0)
+    a, b   =  a[:, valid], b[:, valid]
+    return (a @ b.T) / np.sqrt(np.outer(np.sum(a ** 2, axis=1), np.sum(b ** 2, axis=1)))
+
+
+def _attach():
+    # each worker maps the packed matrix from shared memory once, without a copy
+    if 'X' not in WORKER:
+        name, shape, dtype = WORKER['shm_args']
+        WORKER['shm'] = shared_memory.SharedMemory(name=name)
+        WORKER['X']   = np.ndarray(shape, dtype=dtype, buffer=WORKER['shm'].buf)
+    return WORKER['X']
+
+
+def _boot_eofs(seed, size, block, V, neofs, method):
+    # variance fractions and congruence with V of SIZE block-resampled fits
+    X      =  _attach()
+    rng    =  np.random.default_rng(seed)
+    idx    =  block_indices(len(X), block, size, rng)
+    frac   =  np.empty((size, neofs))
+    cong   =  np.empty((size, neofs))
+    for j in range(size):
+        E, _, _, f =  eof(X[idx[:, j]], neofs, method=method, seed=rng.integers(2 ** 32))
+        c          =  np.abs(V @ E.T)                # E rows are unit vectors
+        match      =  np.argmax(c, axis=1)           # modes may swap between replicates
+        frac[j]    =  f[match]
+        cong[j]    =  c[np.arange(neofs), match]
+    return frac, cong
+
+
+def eof_bootstrap(data, neofs=2, nboot=200, block=None, weights=None, alpha=0.05, method='auto',
+                  seed=None, workers=1, batch=10):
+    '''
+    Moving-block bootstrap of the EOFs of a (time, ...) field, or of the
+    packed matrix of a functions.PackedGrid: the time steps are resampled
+    in blocks of 'block' steps (default: field_significance.block_length of
+    PC1) and each replicate is solved with functions.eof. The packed matrix
+    is put in shared memory once and the batches of replicates are run by
+    parallel.run_batches on 'workers' processes. Each replicate mode is
+    matched to the data mode of largest |congruence|. Returns a dictionary:
+
+      frac         variance fractions of the data
+      frac_ci      (2, neofs) bootstrap interval of level 1 - alpha
+      congruence   (nboot, neofs) |congruence| of each replicate pattern
+                   with the one of the data
+      cong_mean    mean |congruence| per mode (pattern stability)
+      cong_low     its alpha quantile
+      north_err    North et al. (1982) errors of frac, with n the effective
+                   sample size of PC1
+      separated    modes separated by the North test
+      block        block length used
+    '''
+    x      =  np.asarray(data.data if isinstance(data, PackedGrid) else getattr(data, 'values', data),
+                         dtype=float)
+    X      =  x.reshape(len(x), -1)
+    if weights is not None:
+        X  =  X * np.broadcast_to(np.asarray(weights, dtype=float), x.shape[1:]).reshape(-1)
+    X      =  np.ascontiguousarray(X[:, np.all(np.isfinite(X), axis=0)])
+
+    E, PC, lmbd, frac = eof(X, neofs, method=method, seed=seed)
+    n_eff  =  float(eff_sample(PC[:, 0]))
+    block  =  block_length(PC[:, 0]) if block is None else int(block)
+
+    shm    =  shared_memory.SharedMemory(create=True, size=X.nbytes)
+    try:
+        np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+        stats  =  run_batches(_boot_eofs, nboot, batch, seed, block, E, neofs, method, workers=workers,
+                              state=dict(shm_args=(shm.name, X.shape, X.dtype)))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    fboot  =  np.concatenate([s[0] for s in stats])
+    cong   =  np.concatenate([s[1] for s in stats])
+    err, sep = north_test(lmbd, n_eff, frac)
+    return dict(frac       = frac,
+                frac_ci    = np.quantile(fboot, [alpha / 2, 1 - alpha / 2], axis=0),
+                congruence = cong,
+                cong_mean  = cong.mean(axis=0),
+                cong_low   = np.quantile(cong, alpha, axis=0),
+                north_err  = err,
+                separated  = sep,
+                block      = block)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+
+'''
+ File Name: field_significance.py
+ Description: Field significance of correlation and regression maps.
+ Observations: Testing every grid point on its own (functions.t_test, the
+ p-value hatching of pearson_correlation.py) lets many points pass by chance.
+ fdr() controls the false discovery rate (Benjamini and Hochberg 1995; Wilks
+ 2016 suggests alpha_FDR = 2 * alpha), walker() tests the whole field with the
+ smallest p-value, and block_bootstrap() builds the null distribution of the
+ correlation maps with a moving-block bootstrap of the index, which keeps its
+ serial correlation (Wilks 1997; Livezey and Chen 1983). The test of a
+ regression slope on one index is the one of its correlation, so the same
+ functions apply to regression maps.
+ Author: Willy Hagi
+ E-mail: hagi.willy@gmail.com
+ Python Version: 3.7.3
+'''
+
+
+import numpy               as np
+import xarray              as xr
+
+from functions             import correlate, lag1, align_field, grid_result
+from parallel              import run_batches, WORKER
+
+
+
+
+
+##----------------------- MULTIPLE TESTING
+
+
+def _values(p):
+    # p-values as a flat array and a function to shape results back like p
+    if isinstance(p, xr.DataArray):
+        return p.values.ravel(), lambda v: p.copy(data=v.reshape(p.shape))
+    p = np.asarray(p, dtype=float)
+    return p.ravel(), lambda v: v.reshape(p.shape)
+
+
+def fdr(p, alpha=0.1):
+    '''
+    False discovery rate control of Benjamini and Hochberg (1995) over all
+    the (non-missing) p-values of a map. Returns the map of significant
+    points and the p-value threshold p_fdr (0 if no point passes).
+    '''
+    flat, like =  _values(p)
+    valid      =  np.isfinite(flat)
+    ps         =  np.sort(flat[valid])
+    K          =  ps.size
+    below      =  ps <= alpha * np.arange(1, K + 1) / max(K, 1)
+    p_fdr      =  ps[np.flatnonzero(below)[-1]] if below.any() else 0.
+    return like(valid & (np.where(valid, flat, 1.) <= p_fdr)), p_fdr
+
+
+def walker(p, alpha=0.05):
+    '''
+    Walker's test: the field is significant at level alpha if its smallest
+    p-value is below 1 - (1 - alpha) ** (1 / K), for K independent tests.
+    Returns (significant, p_walker, p_field), where p_field is the global
+    p-value 1 - (1 - min(p)) ** K.
+    '''
+    flat, _    =  _values(p)
+    flat       =  flat[np.isfinite(flat)]
+    K          =  flat.size
+    p_walker   =  1 - (1 - alpha) ** (1. / K)
+    p_field    =  1 - (1 - flat.min()) ** K
+    return bool(flat.min() <= p_walker), p_walker, float(p_field)
+
+
+
+
+
+##----------------------- BLOCK BOOTSTRAP
+
+
+def block_length(x):
+    '''
+    Block length for the moving-block bootstrap of a series x, from its
+    lag-1 autocorrelation (Wilks 1997): L = (N - L + 1) ** ((2/3)(1 - N'/N)),
+    with N' = N (1 - r1) / (1 + r1), solved by fixed-point iteration.
+    '''
+    N   =  np.isfinite(x).sum()
+    r1  =  max(float(lag1(np.asarray(x, dtype=float)[np.isfinite(x)])), 0.)
+    Ne  =  N * (1 - r1) / (1 + r1)
+    L   =  1.
+    for _ in range(50):
+        L = (N - L + 1) ** ((2. / 3.) * (1 - Ne / N))
+    return max(1, int(round(L)))
+
+
+def block_indices(T, block, size, rng):
+    # time indices of SIZE moving-block resamples, as a (T, size) matrix
+    nblocks  =  int(np.ceil(T / block))
+    starts   =  rng.integers(0, T - block + 1, (size, nblocks))
+    idx      =  (starts[:, :, np.newaxis] + np.arange(block)).reshape(size, -1)[:, :T]
+    return idx.T
+
+
+def _boot_batch(seed, size, block, r, alpha):
+    # exceedances of |r| per point and number of locally significant points
+    x, y     =  WORKER['x'], WORKER['y']
+    rng      =  np.random.default_rng(seed)
+    rb, pb   =  correlate(x, y[block_indices(len(y), block, size, rng)])
+    exceed   =  np.sum(np.abs(rb) >= np.abs(r), axis=0)
+    count    =  np.sum(pb <= alpha, axis=-1)
+    return exceed, count
+
+
+def block_bootstrap(field, index, nboot=1000, block=None, alpha=0.05, dim='time', seed=None,
+                    workers=1, batch=50):
+    '''
+    Moving-block bootstrap of the correlation map between an index and a
+    field (e.g. the inputs of pearson_correlation.py). The index is resampled
+    in blocks of 'block' time steps (default block_length(index)), which keeps
+    its serial correlation but breaks its relation with the field; each batch
+    of 'batch' resamples is one call of functions.correlate, run by
+    parallel.run_batches on 'workers' processes. Returns a dictionary with:
+
+      r         correlation map of the data
+      p         bootstrap p-value of every point, P(|r*| >= |r|); it is at
+                least 1 / (nboot + 1), so nboot must be large for fdr()
+                over many points
+      count     number of points with a t-test p-value below alpha
+      p_field   fraction of resamples with at least as many such points
+                (Livezey and Chen 1983)
+      block     block length used
+    '''
+    field, y, _, like = align_field(field, index, dim)
+    x      =  field.reshape(len(field), -1)
+    block  =  block_length(y) if block is None else int(block)
+
+    r, p   =  correlate(x, y)
+    count  =  int(np.sum(p <= alpha))
+    stats  =  run_batches(_boot_batch, nboot, batch, seed, block, r, alpha, workers=workers,
+                          state=dict(x=x, y=y))
+
+    exceed =  sum(s[0] for s in stats)
+    counts =  np.concatenate([s[1] for s in stats])
+    pboot  =  np.where(np.isfinite(r), (exceed + 1.) / (nboot + 1.), np.nan)
+
+    gshape =  field.shape[1:]
+    r      =  grid_result(r.reshape(gshape), like, 'r')
+    pboot  =  grid_result(pboot.reshape(gshape), like, 'p')
+    return dict(r=r, p=pboot, count=count, p_field=(np.sum(counts >= count) + 1.) / (nboot + 1.),
+                block=block)
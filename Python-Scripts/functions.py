@@ -15,7 +15,8 @@
 import numpy               as np
 import xarray              as xr
 
-from scipy.stats          import pearsonr
+from scipy                import sparse
+from scipy.stats          import norm, t as student_t
 
 
 
@@ -65,23 +66,147 @@ class Demean:
 
 
 
-##----- select months for seasonal calculations
+##----- area-weighted indices of several regions at once
+
+# boxes as (lat1, lat2, lon1, lon2), longitudes in degrees east (0-360)
+REGIONS = {'nino12' : ( 0., -10., 270., 280.),
+           'nino3'  : ( 5.,  -5., 210., 270.),
+           'nino34' : ( 5.,  -5., 190., 240.),
+           'nino4'  : ( 5.,  -5., 160., 210.),
+           'amazon' : ( 5., -15., 285., 310.)}
+
+class Indices:
+    '''
+    Cos(lat)-weighted area averages of several named regions (default:
+    REGIONS) from one read of the data, as a sparse (region, lat * lon)
+    weight matrix applied to the packed spatial dimension, flattened with
+    'order' ('F' as Nan_calc and PackedGrid). Boxes may cross the date line
+    (lon1 > lon2) and work with -180..180 grids too.
+    '''
+    def __init__(self, lat, lon, regions=None, order='F'):
+        self.regions =  dict(REGIONS if regions is None else regions)
+        self.lat     =  np.asarray(lat, dtype=float)
+        self.lon     =  np.asarray(lon, dtype=float)
+        self.order   =  order
+        glat, glon   =  np.meshgrid(self.lat, self.lon, indexing='ij')
+        coslat       =  np.cos(np.deg2rad(glat)).ravel(order=order)
+        rows, cols   =  [], []
+        for i, (lat1, lat2, lon1, lon2) in enumerate(self.regions.values()):
+            inside   =  ((glat >= min(lat1, lat2)) & (glat <= max(lat1, lat2)) &
+                         ((glon - lon1) % 360. <= (lon2 - lon1) % 360.)).ravel(order=order)
+            cols.append(np.flatnonzero(inside))
+            rows.append(np.full(cols[-1].size, i))
+        rows, cols   =  np.concatenate(rows), np.concatenate(cols)
+        self.weights =  sparse.csr_matrix((coslat[cols], (rows, cols)),
+                                          shape=(len(self.regions), coslat.size))
+
+    def project(self, x):
+        '''
+        Indices of a packed (time, lat * lon) block; missing values are left
+        out of both the weighted sum and the sum of weights.
+        '''
+        valid  =  np.isfinite(x)
+        num    =  self.weights @ np.where(valid, x, 0.).T
+        den    =  self.weights @ valid.T.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (num / den).T
+
+    def compute(self, data, chunk=None, dim='time'):
+        '''
+        Indices of a (time, lat, lon) DataArray or packed array, reading
+        'chunk' time steps at a time (e.g. from a lazily opened netcdf file).
+        Returns a (time, region) DataArray or array.
+        '''
+        if isinstance(data, xr.DataArray):
+            data   =  data.transpose(dim, 'lat', 'lon')
+        T      =  data.shape[0]
+        chunk  =  chunk or T
+        out    =  np.empty((T, len(self.regions)))
+        for i in range(0, T, chunk):
+            block  =  data[i:i + chunk]
+            block  =  np.asarray(getattr(block, 'values', block), dtype=float)
+            out[i:i + chunk] = self.project(block.reshape(len(block), -1, order=self.order))
+        if isinstance(data, xr.DataArray):
+            return xr.DataArray(out, coords={dim: data[dim], 'region': list(self.regions)},
+                                dims=(dim, 'region'))
+        return out
+
+    def stream(self, path, var, chunk=120):
+        # indices of a variable of a netcdf file, read in time chunks
+        with xr.open_dataset(path) as dset:
+            x = dset[var]
+            return Indices(x['lat'], x['lon'], self.regions, self.order).compute(x, chunk)
+
+
+
+##----- select months for seasonal calculations and running seasonal means
 
 class Seasonal:
-    def __init__(self, data, m1, m2, m3): # this can be extended to n months
-        self.data  =  data
-        self.m1    =  m1
-        self.m2    =  m2
-        self.m3    =  m3
+    def __init__(self, data, *months, dim='time'):
+        # any number of months, e.g. Seasonal(data, 12, 1, 2) for DJF
+        self.data    =  data
+        self.months  =  list(months)
+        self.dim     =  dim
 
     def select_months(self, month):
-        return (month == self.m1) | (month == self.m2) | (month == self.m3)
+        return np.isin(month, self.months)
 
     def season(self):
         # season will return n months for the whole time period of your dataset
         self.svar =  self.data.sel(time = self.select_months(self.data['time.month']))
         return self.svar
 
+    def running(self, window=None, min_periods=None):
+        '''
+        All overlapping running seasonal means of 'window' months (default:
+        the number of months given), e.g. DJF, JFM, ... as in the ONI, for the
+        whole cube at once from cumulative sums along time. Each mean is put at
+        the last month of its window and labelled with the 'season' letters
+        and the 'season_year' (the year of that last month, so DJF 1998 is
+        Dec 1997 - Feb 1998). Windows with fewer than min_periods (default:
+        window) valid months are NaN. The data must be monthly and without
+        gaps in time.
+        '''
+        window  =  window or len(self.months)
+        minp    =  window if min_periods is None else min_periods
+        x       =  self.data.transpose(self.dim, ...)
+        steps   =  x[self.dim].dt.year.values * 12 + x[self.dim].dt.month.values
+        if np.any(np.diff(steps) != 1):
+            raise ValueError('Seasonal.running needs consecutive monthly data along ' + self.dim)
+        v       =  np.asarray(x.values, dtype=float)
+        valid   =  np.isfinite(v)
+        zero    =  np.zeros((1,) + v.shape[1:])
+        csum    =  np.concatenate((zero, np.cumsum(np.where(valid, v, 0.), axis=0)))
+        ccnt    =  np.concatenate((zero, np.cumsum(valid, axis=0)))
+        total   =  csum[window:] - csum[:-window]
+        count   =  ccnt[window:] - ccnt[:-window]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean    =  np.where(count >= minp, total / count, np.nan)
+        out     =  np.full(v.shape, np.nan)
+        out[window - 1:] = mean
+
+        month   =  x[self.dim].dt.month.values
+        letters =  'JFMAMJJASOND' * 2
+        labels  =  [letters[m + 12 - window:m + 12] for m in month]
+        xn      =  x.copy(data=out)
+        xn      =  xn.assign_coords(season=(self.dim, labels), season_year=(self.dim, x[self.dim].dt.year.values))
+        return xn.transpose(*self.data.dims)
+
+    def seasonal_mean(self, min_periods=None):
+        '''
+        One mean per season-year over the (consecutive) months given, e.g.
+        Seasonal(data, 12, 1, 2).seasonal_mean() for DJF, from the running
+        means. The time dimension is kept (the last month of each season),
+        with 'season_year' as a coordinate, so the result can go straight to
+        composites or EOFs.
+        '''
+        months  =  [(m - 1) % 12 + 1 for m in self.months]
+        last    =  [m for m in months if m % 12 + 1 not in months]
+        if len(last) != 1 or len(set(months)) != len(months):
+            raise ValueError('Months must be consecutive, e.g. 12, 1, 2')
+        run     =  self.running(len(months), min_periods)
+        return run.sel({self.dim: run[self.dim].dt.month == last[0]})
+
 
 
 ##----- masking NaN values from gridded data
@@ -98,14 +223,87 @@ class Nan_calc:
         return self.xres
 
     def masking_array(self):
-        self.masked_array  =  np.ma.masked_array(self.xres, np.isnan(self.xres))
-        self.nan_values    =  self.masked_array.sum(0).mask
-        self.values        =  ~self.nan_values
+        # columns with at least one valid value, without a masked copy of xres
+        self.values        =  np.isfinite(self.xres).any(axis=0)
+        self.nan_values    =  ~self.values
         self.x_masked      =  self.xres[:,self.values]
         return self.values, self.x_masked
 
 
 
+##----- packed grid of valid points
+class PackedGrid:
+    '''
+    Valid points of a (time, lat, lon) field packed into a (time, points)
+    matrix, plus the flat index of each point in the grid. The grid is
+    flattened with 'order' ('F' as Nan_calc and rec_matrix); a point is valid
+    if it has at least one finite value (how='any', as Nan_calc) or no missing
+    value (how='all'). The field is read 'chunk' time steps at a time, so it
+    can be a lazily opened netcdf variable, and with 'path' the packed matrix
+    is a memory-mapped .npy file that other pipelines can open() and share.
+    '''
+    def __init__(self, x, order='F', how='any', chunk=None, path=None, dtype=None):
+        self.order =  order
+        self.grid  =  tuple(x.shape[1:])
+        self.ntime =  x.shape[0]
+        chunk      =  chunk or self.ntime
+        dtype      =  np.dtype(dtype or np.result_type(x.dtype, np.float32))
+
+        if how not in ('any', 'all'):
+            raise ValueError("how must be either 'any' or 'all'")
+        found      =  np.full(int(np.prod(self.grid)), how == 'all')
+        for i in range(0, self.ntime, chunk):
+            valid  =  np.isfinite(np.asarray(getattr(x[i:i + chunk], 'values', x[i:i + chunk])))
+            valid  =  (valid.any(axis=0) if how == 'any' else valid.all(axis=0)).ravel(order=order)
+            found  =  (found | valid) if how == 'any' else (found & valid)
+        self.values =  found
+        self.index  =  np.flatnonzero(found)
+        self.points =  np.unravel_index(self.index, self.grid, order=order)
+
+        shape      =  (self.ntime, self.index.size)
+        if path is None:
+            self.data = np.empty(shape, dtype=dtype)
+        else:
+            self.data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            np.savez(path + '.grid.npz', index=self.index, grid=self.grid, order=order)
+        for i in range(0, self.ntime, chunk):
+            self.data[i:i + chunk] = self.pack(x[i:i + chunk])
+        if path is not None:
+            self.data.flush()
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        # packed grid saved with 'path', memory-mapped (read-only by default)
+        self        =  cls.__new__(cls)
+        meta        =  np.load(path + '.grid.npz')
+        self.index  =  meta['index']
+        self.grid   =  tuple(int(n) for n in meta['grid'])
+        self.order  =  str(meta['order'])
+        self.values =  np.zeros(int(np.prod(self.grid)), dtype=bool)
+        self.values[self.index] = True
+        self.points =  np.unravel_index(self.index, self.grid, order=self.order)
+        self.data   =  np.load(path, mmap_mode=mode)
+        self.ntime  =  self.data.shape[0]
+        return self
+
+    def pack(self, x):
+        # (time, lat, lon) -> (time, points), one fancy-index operation
+        return np.asarray(getattr(x, 'values', x))[(slice(None),) + self.points]
+
+    def unpack(self, p, fill=np.nan, masked=False):
+        '''
+        (.., points) -> (.., lat, lon), with 'fill' outside the valid points,
+        or a masked array like rec_matrix if masked=True.
+        '''
+        p      =  np.asarray(p)
+        out    =  np.full(p.shape[:-1] + self.grid, fill,
+                          dtype=np.result_type(p.dtype, np.min_scalar_type(fill)))
+        out[(Ellipsis,) + self.points] = p
+        if masked:
+            mask = np.broadcast_to(np.reshape(~self.values, self.grid, order=self.order), out.shape)
+            return np.ma.masked_array(out, mask)
+        return out
+
 
 
 ##----------------------- FUNCTIONS
@@ -119,9 +317,8 @@ def anom(x,y):
 
 # matrix reconstruction
 def rec_matrix(x, time, lat, lon, val):
-    rec  =  np.ones( (len(time), len(lat)*len(lon)) ) * -999.
-    for i in range(len(time)):
-        rec[i,val]  =  x[i,:]
+    rec  =  np.full( (len(time), len(lat)*len(lon)), -999. )
+    rec[:,val]  =  x
     rec_res    =  np.reshape(rec, (len(time), len(lat), len(lon)), order='F')
     rec_final  =  np.ma.masked_values(rec_res, -999.)
     return rec_final
@@ -135,7 +332,7 @@ def eof_svd(F):
     V        =  np.real(V)            # right singular vectors
     #
     lmbd     =  g **2.                # eigenvalues
-    PC       =  np.dot(np.diag(g), U) # principal components
+    PC       =  g[:, np.newaxis] * U  # principal components, diag(g) U without diag
     EOF      =  np.dot(V.transpose(), PC)         # EOF projection
     return U, V, g, lmbd, PC.transpose(), EOF
 
@@ -147,14 +344,95 @@ def eof_norm(PC, V, lmbd):
     return PCnor, EOFnor
 
 
+# truncated EOF solver
+def eof(F, neofs=None, weights=None, method='auto', center=True, normalize=False, seed=None):
+    '''
+    Leading 'neofs' EOFs of F (time, ...), e.g. a PackedGrid matrix or a
+    (time, lat, lon) array, without a full SVD. 'weights' multiply the data
+    before the decomposition, like the sqrt(cos(lat)) weights that eof.py
+    gives to eofs.xarray.Eof; the EOFs are those of the weighted data.
+    Points with missing values are left out (NaN in the EOFs). The method is
+    picked from the shape unless given:
+
+      'randomized'  randomized SVD (Halko et al. 2011) for a few modes
+                    (neofs <= min(T, S) / 10) of a matrix large both ways
+      'gram'        eigenvectors of the time x time (or space x space)
+                    matrix, for one dimension much smaller than the other
+      'svd'         full SVD, truncated
+
+    Returns EOF (neofs, ...), PC (time, neofs), lmbd = g ** 2 (as eof_svd)
+    and the fraction of variance of each mode. With normalize=True, EOF and
+    PC are scaled as in eof_norm (PC / sqrt(lmbd), EOF * sqrt(lmbd)). Signs
+    are fixed so that the largest loading of each EOF is positive.
+    '''
+    F      =  np.asarray(getattr(F, 'values', F), dtype=float)
+    shape  =  F.shape[1:]
+    X      =  F.reshape(len(F), -1)
+    if weights is not None:
+        X  =  X * np.broadcast_to(np.asarray(weights, dtype=float), shape).reshape(-1)
+    valid  =  np.all(np.isfinite(X), axis=0)
+    X      =  X[:, valid]
+    if center:
+        X  =  X - X.mean(axis=0)
+    T, S   =  X.shape
+    small  =  min(T, S)
+    k      =  small if neofs is None else min(neofs, small)
+
+    if method == 'auto':
+        if k <= small // 10 and small > 1000:
+            method = 'randomized'
+        elif max(T, S) >= 4 * small:
+            method = 'gram'
+        else:
+            method = 'svd'
+
+    if method == 'gram':
+        if T <= S:
+            lm, U  =  np.linalg.eigh(X @ X.T)
+            lm, U  =  lm[::-1][:k], U[:, ::-1][:, :k]
+            g      =  np.sqrt(np.maximum(lm, 0.))
+            V      =  (X.T @ U / np.where(g > 0, g, 1.)).T
+        else:
+            lm, W  =  np.linalg.eigh(X.T @ X)
+            lm, W  =  lm[::-1][:k], W[:, ::-1][:, :k]
+            g      =  np.sqrt(np.maximum(lm, 0.))
+            U, V   =  X @ W / np.where(g > 0, g, 1.), W.T
+    elif method == 'randomized':
+        rng    =  np.random.default_rng(seed)
+        Q      =  X @ rng.standard_normal((S, k + 10))
+        for _ in range(4):  # power iterations, re-orthonormalized
+            Q, _ =  np.linalg.qr(Q)
+            Q, _ =  np.linalg.qr(X.T @ Q)
+            Q    =  X @ Q
+        Q, _   =  np.linalg.qr(Q)
+        Ub, g, V = np.linalg.svd(Q.T @ X, full_matrices=False)
+        U, g, V  = (Q @ Ub)[:, :k], g[:k], V[:k]
+    elif method == 'svd':
+        U, g, V  = np.linalg.svd(X, full_matrices=False)
+        U, g, V  = U[:, :k], g[:k], V[:k]
+    else:
+        raise ValueError("method must be 'auto', 'gram', 'randomized' or 'svd'")
+
+    sign   =  np.sign(V[np.arange(k), np.argmax(np.abs(V), axis=1)])
+    U, V   =  U * sign, V * sign[:, np.newaxis]
+    lmbd   =  g ** 2.
+    frac   =  lmbd / np.sum(X ** 2)
+    PC     =  U * g
+    if normalize:
+        PC, Vn =  eof_norm(PC, V.T, lmbd)
+        V      =  Vn.T
+    EOF    =  np.full((k, valid.size), np.nan)
+    EOF[:, valid] = V
+    return EOF.reshape((k,) + shape), PC, lmbd, frac
+
+
 # column-wise pearson linear correlation coefficient
-def pearson(matrix, index, grid):
-    cont = 0
-    r    =  np.zeros(grid)
-    p    =  np.zeros(grid)
-    for i in np.arange(1, grid, 1):
-        r[cont], p[cont] = pearsonr(matrix[:,i-1], index)
-        cont += 1
+def pearson(matrix, index, grid=None):
+    '''
+    r and p of every column of a (time, grid) matrix (e.g. from Nan_calc)
+    against an index; a thin wrapper of correlate kept for older scripts.
+    '''
+    r, p  =  correlate(matrix[:, :grid], index)
     return r, p
 
 
@@ -171,3 +449,286 @@ def t_comp(x, N, ttab):
     varx   =  np.sqrt(x.var() / N)
     tcalc  =  x / varx
     return tcalc / ttab  
+
+
+
+
+
+##----------------------- AUTOCORRELATION
+
+# helpers to put the time axis last: xarray objects use 'dim', numpy arrays
+# are (time, ...) like the matrices of Nan_calc
+def _time_last(x, dim):
+    if isinstance(x, xr.DataArray):
+        x  =  x.transpose(..., dim)
+        return np.asarray(x.values, dtype=float), x
+    return np.moveaxis(np.asarray(x, dtype=float), 0, -1), None
+
+
+def _time_first(values, like, name, dim):
+    # result with a new leading dimension 'name' (or none) back to x's type
+    if like is None:
+        return values if name is None else np.moveaxis(values, -1, 0)
+    gdims  =  like.dims[:-1]
+    coords =  {d: like[d] for d in gdims if d in like.coords}
+    if name is None:
+        return xr.DataArray(values, coords=coords, dims=gdims)
+    coords[name] = np.arange(values.shape[-1])
+    return xr.DataArray(values, coords=coords, dims=gdims + (name,)).transpose(name, ...)
+
+
+def acf(x, nlags=None, dim='time', unbiased=False):
+    '''
+    Autocorrelation function along the time axis of every series in x, for
+    lags 0..nlags (default N - 1), from one zero-padded FFT of the whole cube.
+    With unbiased=True the autocovariance at lag k is divided by N - k instead
+    of N, as in statsmodels' acf. Series with missing values give NaN.
+    Returns an array (lag, ...) or a DataArray with a 'lag' dimension.
+    '''
+    y, like  =  _time_last(x, dim)
+    N        =  y.shape[-1]
+    nlags    =  N - 1 if nlags is None else min(nlags, N - 1)
+    y        =  y - y.mean(axis=-1, keepdims=True)
+    nfft     =  int(2 ** np.ceil(np.log2(2 * N - 1)))
+    f        =  np.fft.rfft(y, n=nfft, axis=-1)
+    acov     =  np.fft.irfft(f.real ** 2 + f.imag ** 2, n=nfft, axis=-1)[..., :nlags + 1]
+    if unbiased:
+        acov =  acov / (N - np.arange(nlags + 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r    =  acov / acov[..., :1]
+    return _time_first(r, like, 'lag', dim)
+
+
+def lag1(x, dim='time'):
+    '''
+    Lag-1 autocorrelation (AR(1) coefficient) map of x, e.g. for the red-noise
+    background of waveletFunctions.wave_signif, which accepts it as an array.
+    '''
+    y, like  =  _time_last(x, dim)
+    y        =  y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r    =  np.sum(y[..., 1:] * y[..., :-1], axis=-1) / np.sum(y ** 2, axis=-1)
+    return _time_first(r, like, None, dim)
+
+
+def acf_confint(r, N, alpha=0.05):
+    '''
+    Half-width of the (1 - alpha) confidence band of an ACF r (lag first),
+    with Bartlett's formula as in statsmodels: the band of lag k is
+    z * sqrt((1 + 2 * sum(r[1:k] ** 2)) / N).
+    '''
+    r        =  np.asarray(r, dtype=float)
+    var      =  np.ones_like(r) / N
+    var[2:]  =  (1 + 2 * np.cumsum(r[1:-1] ** 2, axis=0)) / N
+    var[0]   =  0.
+    return norm.ppf(1 - alpha / 2.) * np.sqrt(var)
+
+
+def decorrelation(x, nlags=None, dim='time', alpha=0.05, unbiased=False):
+    '''
+    Decorrelation time, in time steps, of every series in x: the first lag
+    whose autocorrelation falls inside the (1 - alpha) Bartlett band (NaN if
+    none does up to nlags).
+    '''
+    y, like  =  _time_last(x, dim)
+    r        =  np.moveaxis(acf(np.moveaxis(y, -1, 0), nlags, unbiased=unbiased), 0, -1)
+    inside   =  r < np.moveaxis(acf_confint(np.moveaxis(r, -1, 0), y.shape[-1], alpha), 0, -1)
+    inside[..., 0] = False
+    tau      =  np.where(inside.any(axis=-1), inside.argmax(axis=-1), np.nan)
+    return _time_first(tau, like, None, dim)
+
+
+def eff_sample(x, dim='time', method='ar1', nlags=None, alpha=0.05):
+    '''
+    Effective sample size of every series in x, to be used as dof in t_test:
+      'ar1'  N * (1 - r1) / (1 + r1), with r1 the lag-1 autocorrelation
+             (Bretherton et al. 1999)
+      'acf'  N / tau, with tau the decorrelation time of decorrelation()
+    '''
+    N        =  x.sizes[dim] if isinstance(x, xr.DataArray) else np.shape(x)[0]
+    if method == 'ar1':
+        r1   =  lag1(x, dim)
+        return N * (1 - r1) / (1 + r1)
+    if method == 'acf':
+        return N / decorrelation(x, nlags, dim, alpha)
+    raise ValueError("method must be either 'ar1' or 'acf'")
+
+
+
+
+
+##----------------------- CORRELATION
+
+# helpers for the maps of an index against a field: the field as a (time,
+# ...) array and the results back over its grid, as DataArrays if it was one
+def align_field(field, index, dim='time', dof=None):
+    '''
+    Field and index as float arrays with time first, aligned on 'dim' when
+    both are DataArrays, and 'dof' (e.g. from eff_sample) as an array over
+    the grid. Also returns the transposed field DataArray (None for arrays)
+    to give to grid_result.
+    '''
+    like   =  None
+    if isinstance(field, xr.DataArray):
+        if isinstance(index, xr.DataArray) and dim in index.coords and dim in field.coords:
+            field, index = xr.align(field, index, join='inner')
+        like   =  field.transpose(dim, ...)
+        field  =  like.values
+        if isinstance(dof, xr.DataArray):
+            dof = dof.transpose(*like.dims[1:]).values
+    return np.asarray(field, dtype=float), np.asarray(index, dtype=float), dof, like
+
+
+def grid_result(values, like, name, lead=None, coord=None):
+    '''
+    A (grid...) or (lead, grid...) result as a DataArray over the grid of
+    'like' from align_field, with 'coord' as the values of the leading
+    dimension if given; unchanged if like is None.
+    '''
+    if like is None:
+        return values
+    gdims  =  like.dims[1:]
+    coords =  {d: like[d] for d in gdims if d in like.coords}
+    if lead is None:
+        return xr.DataArray(values, coords=coords, dims=gdims, name=name)
+    if coord is not None:
+        coords[lead] = coord
+    return xr.DataArray(values, coords=coords, dims=(lead,) + gdims, name=name)
+
+
+def correlate(field, index, dim='time', dof=None, chunk=65536):
+    '''
+    Pearson correlation r and its two-sided p-value between an index and every
+    series of a field, with matrix products instead of a loop over points.
+    'field' is a (time, ...) array, e.g. the packed matrix of Nan_calc, or a
+    DataArray with a 'dim' dimension; 'index' is (time,) or (time, k) for k
+    indices at once (then r and p get a leading dimension of size k).
+    Missing values are dropped pairwise, series by series. 'dof' replaces the
+    number of valid pairs in the t-test (scalar or map, e.g. from eff_sample).
+    The field is processed in chunks of 'chunk' series to bound memory.
+    '''
+    x, y, dof, like = align_field(field, index, dim, dof)
+    single =  y.ndim == 1
+    y      =  y.reshape(len(y), -1)
+    gshape =  x.shape[1:]
+    x      =  x.reshape(len(x), -1)
+
+    r      =  np.full((y.shape[1], x.shape[1]), np.nan)
+    n      =  np.zeros((y.shape[1], x.shape[1]))
+    my     =  np.isfinite(y).astype(float)
+    y0     =  np.where(my > 0, y, 0.)
+    y0     =  np.where(my > 0, y0 - y0.sum(axis=0) / my.sum(axis=0), 0.)
+    for i in range(0, x.shape[1], chunk):
+        xc     =  x[:, i:i + chunk]
+        mx     =  np.isfinite(xc).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x0 =  np.where(mx > 0, xc, 0.)
+            x0 =  np.where(mx > 0, x0 - x0.sum(axis=0) / mx.sum(axis=0), 0.)
+            N  =  my.T @ mx                              # valid pairs
+            Sx =  my.T @ x0 ; Sy  = y0.T @ mx
+            Sxx = my.T @ x0 ** 2 ; Syy = (y0 ** 2).T @ mx
+            Sxy = y0.T @ x0
+            cov  =  Sxy - Sx * Sy / N
+            r[:, i:i + chunk] = cov / np.sqrt((Sxx - Sx ** 2 / N) * (Syy - Sy ** 2 / N))
+        n[:, i:i + chunk] = N
+
+    r      =  np.clip(r, -1., 1.)
+    dof    =  n if dof is None else np.broadcast_to(np.reshape(np.asarray(dof, dtype=float), (1, -1)), n.shape)
+    p      =  _pvalue(r, dof)
+
+    r, p   =  r.reshape((-1,) + gshape), p.reshape((-1,) + gshape)
+    if single:
+        return grid_result(r[0], like, 'r'), grid_result(p[0], like, 'p')
+    return grid_result(r, like, 'r', 'index'), grid_result(p, like, 'p', 'index')
+
+
+def _pvalue(r, dof):
+    # two-sided p-value of the student t-test of r with dof - 2 degrees of freedom
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tval =  r * np.sqrt((dof - 2.) / (1. - r ** 2))
+        p    =  2 * student_t.sf(np.abs(tval), dof - 2.)
+    return np.where(dof > 2, p, np.nan)
+
+
+def _xcorr(a, b, lags, nfft):
+    # sum_t a[t] * b[t + k] for every lag k, along the first axis
+    c  =  np.fft.irfft(np.conj(np.fft.rfft(a, n=nfft, axis=0)) * np.fft.rfft(b, n=nfft, axis=0),
+                       n=nfft, axis=0)
+    return c[np.asarray(lags) % nfft]
+
+
+def lag_correlate(field, index, lags=12, dim='time', dof=None, chunk=16384):
+    '''
+    Lagged Pearson correlation between an index and every series of a field,
+    for all lags at once: r(k) = corr(index[t], field[t + k]), so positive
+    lags mean the index leads. 'lags' is a maximum lag L (lags -L..L) or a
+    sequence of lags. Each sum of the lagged correlations is one FFT
+    cross-correlation along time, so missing values are dropped pairwise for
+    every lag and point without a loop. 'dof' is an effective sample size
+    (scalar or map, e.g. eff_sample) for the full series, scaled at each lag
+    by the fraction of valid pairs; the other options are the ones of
+    correlate. Returns r and p as (lag, ...) arrays or DataArrays.
+    '''
+    lags   =  np.arange(-lags, lags + 1) if np.ndim(lags) == 0 else np.asarray(lags, dtype=int)
+    x, y, dof, like = align_field(field, index, dim, dof)
+    gshape =  x.shape[1:]
+    x      =  x.reshape(len(x), -1)
+    T      =  len(y)
+    if np.max(np.abs(lags)) >= T:
+        raise ValueError('Lags must be shorter than the time series')
+    nfft   =  int(2 ** np.ceil(np.log2(2 * T - 1)))
+
+    my     =  np.isfinite(y).astype(float)[:, np.newaxis]
+    y0     =  np.where(my > 0, y[:, np.newaxis], 0.)
+    y0     =  np.where(my > 0, y0 - y0.sum() / my.sum(), 0.)
+    r      =  np.full((len(lags), x.shape[1]), np.nan)
+    n      =  np.zeros((len(lags), x.shape[1]))
+    for i in range(0, x.shape[1], chunk):
+        xc     =  x[:, i:i + chunk]
+        mx     =  np.isfinite(xc).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x0 =  np.where(mx > 0, xc, 0.)
+            x0 =  np.where(mx > 0, x0 - x0.sum(axis=0) / mx.sum(axis=0), 0.)
+            N  =  np.round(_xcorr(my, mx, lags, nfft))          # valid pairs
+            Sx =  _xcorr(my, x0, lags, nfft) ; Sy  = _xcorr(y0, mx, lags, nfft)
+            Sxx = _xcorr(my, x0 ** 2, lags, nfft) ; Syy = _xcorr(y0 ** 2, mx, lags, nfft)
+            Sxy = _xcorr(y0, x0, lags, nfft)
+            cov  =  Sxy - Sx * Sy / N
+            var  =  (Sxx - Sx ** 2 / N) * (Syy - Sy ** 2 / N)
+            r[:, i:i + chunk] = np.where(var > 1e-12 * Sxx * Syy, cov / np.sqrt(var), np.nan)
+        n[:, i:i + chunk] = N
+
+    r      =  np.clip(r, -1., 1.)
+    if dof is not None:
+        n  =  np.reshape(np.asarray(dof, dtype=float), (1, -1)) * n / T
+    p      =  _pvalue(r, n)
+
+    r, p   =  r.reshape((-1,) + gshape), p.reshape((-1,) + gshape)
+    return grid_result(r, like, 'r', 'lag', lags), grid_result(p, like, 'p', 'lag', lags)
+
+
+
+
+##----------------------- SLABS
+
+
+def grid_slabs(data, chunk=65536, axis=0):
+    '''
+    Splits a field with time on 'axis' (0 or -1) along its first other
+    dimension into slabs of about 'chunk' grid points, read one at a time
+    (e.g. from a lazily opened netcdf file or a memmap). Yields the slab,
+    the mask of its points without missing values and the values as a
+    (time, points) matrix, or (points, time) for axis=-1.
+    '''
+    first  =  1 if axis == 0 else 0
+    grid   =  data.shape[1:] if axis == 0 else data.shape[:-1]
+    rows   =  max(1, chunk // int(np.prod(grid[1:], dtype=int)))
+    for i in range(0, data.shape[first], rows):
+        sl     =  slice(i, min(i + rows, data.shape[first]))
+        x      =  data[:, sl] if axis == 0 else data[sl]
+        x      =  np.asarray(getattr(x, 'values', x), dtype=float)
+        if axis == 0:
+            x  =  x.reshape(len(x), -1)
+        else:
+            x  =  x.reshape(-1, x.shape[-1])
+        yield sl, np.all(np.isfinite(x), axis=1 - first), x
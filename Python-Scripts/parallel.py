@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+
+'''
+ File Name: parallel.py
+ Description: Random replicates in batches, serially or in a process pool.
+ Observations: Bootstraps and Monte Carlo tests (field_significance.py,
+ eof_tools.py, waveletCoherence.py, waveletFunctions.py) draw many random
+ replicates. run_batches splits them into batches with one child seed each,
+ so the results depend on the seed only, not on the number of workers. Only
+ numpy is needed, so the wavelet scripts can use it without xarray.
+ Author: Willy Hagi
+ E-mail: hagi.willy@gmail.com
+ Python Version: 3.7.3
+'''
+
+
+import numpy               as np
+
+from concurrent.futures    import ProcessPoolExecutor
+
+
+# state of the batch functions of run_batches, one copy per process
+WORKER = {}
+
+def _set_worker(state):
+    WORKER.update(state)
+
+
+def run_batches(func, n, batch, seed, *args, workers=1, state=None):
+    '''
+    Runs n random replicates as calls func(seed, size, *args) of at most
+    'batch' replicates each and returns the list of their results. With
+    workers > 1 the batches run in a process pool. 'state' (a dict, e.g. the
+    data) is sent once to every process and read by func from WORKER.
+    '''
+    sizes  =  [min(batch, n - i) for i in range(0, n, batch)]
+    seeds  =  np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks  =  [(seeds[i], sizes[i]) + args for i in range(len(sizes))]
+    try:
+        if workers == 1:
+            _set_worker(state or {})
+            return [func(*task) for task in tasks]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_set_worker,
+                                 initargs=(state or {},)) as pool:
+            return list(pool.map(func, *zip(*tasks)))
+    finally:
+        WORKER.clear()
@@ -15,7 +15,7 @@ import xarray as xr
 import proplot as plot
 import matplotlib.pyplot as plt
 
-from esmtools.stats import*
+from functions import correlate, Indices, REGIONS
 
 
 # --- read netcdf file
@@ -26,11 +26,11 @@ sst = dset['sst'].sel(time=np.in1d(dset['time.month'], [1, 2, 12]))
 print(sst)
 
 # --- make niño 3.4 index
-nino34 = sst.sel(lat=slice(5, -5), lon=slice(360 - 170, 360 - 120))
-nino34 = nino34.mean(dim=('lat', 'lon'))
+nino34 = Indices(sst['lat'], sst['lon'], {'nino34': REGIONS['nino34']})
+nino34 = nino34.compute(sst).sel(region='nino34')
 
 # --- pearson linear correlation
-pearson_r, p_values = corr(sst, nino34, dim='time', return_p=True)
+pearson_r, p_values = correlate(sst, nino34, dim='time')
 
 # --- plotting
 fig, ax = plot.subplots(axwidth=6., tight=True,
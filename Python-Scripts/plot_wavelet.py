@@ -39,7 +39,7 @@ def autocorrelation(x):
 	'''
 	xp = x-np.mean(x)
 	f = np.fft.fft(xp)
-	p = np.array([np.real(v)**2+np.imag(v)**2 for v in f])
+	p = f.real**2 + f.imag**2
 	pi = np.fft.ifft(p)
 	return np.real(pi)[:int(x.size/2)]/np.sum(xp**2)
 
@@ -54,13 +54,15 @@ realpart  =  np.real(wave)
 
 
 ##--- filtering
-cdelta    =  0.776                              # cdelta=0.776 for morlet wavelet; see table 2 (TC, 1998)
-psi       =  math.pi**(-1/4)                    # for morlet wavelet; see table 2 (TC, 1998)
+cdelta    =  wave_constants(mother)[2]          # cdelta=0.776 for morlet wavelet; see table 2 (TC, 1998)
+psi       =  wave_constants(mother)[5]          # psi0(0)=pi**(-1/4) for morlet wavelet; see table 2 (TC, 1998)
 xnc       =  (dj*math.sqrt(dt))/(cdelta*psi)    # 'constant' part for Eq. 29 (TC, 1998)
 avg       =  np.logical_and(scale>=2.,scale<8.) # filtering scales
 scale_avg =  scale[:, np.newaxis].dot(np.ones(n)[np.newaxis, :]) # expand scale array
 xnv       =  realpart/np.sqrt(scale_avg)        # 'variable' part for Eq. 29
 xn        =  xnc*sum(xnv[avg,:])                # Eq. 29
+# the same in a single call: xn = wave_bandpass(sst, dt, [2, 8], pad, dj, s0, j1, mother)
+# (and wavelet_grid.bandpass_field for every point of a gridded field)
 
 
 ##--- save file
@@ -37,10 +37,10 @@ from __future__ import (absolute_import, division, print_function,
 
 import numpy as np
 import matplotlib.pyplot as plt
-import pycwt as wavelet
 
-from pycwt.helpers import find
 from matplotlib.image import NonUniformImage
+from waveletFunctions import wave_signif
+from waveletCoherence import boxpdf, coherence
 
 
 
@@ -58,139 +58,86 @@ data2 = dict(name='Baltic Sea ice extent',
 t1, s1 = np.loadtxt(data1['file'], unpack=True)
 t2, s2 = np.loadtxt(data2['file'], unpack=True)
 dt = np.diff(t1)[0]
-n1 = t1.size
-n2 = t2.size
-n = min(n1, n2)
 
 
 # Change the probablity density function (PDF) of the data. The time series
 # of Baltic Sea ice extent is highly bi-modal and we therefore transform the
 # timeseries into a series of percentiles. The transformed series probably
 # reacts 'more linearly' to climate.
-s2, _, _ = wavelet.helpers.boxpdf(s2)
-
-
-# Calculates the standard deviation of each time series for later
-# normalization.
-std1 = s1.std()
-std2 = s2.std()
+s2, _, _ = boxpdf(s2)
 
 
+# Due to the difference in the time series, the second signal
+# has to be trimmed for the XWT process.
+s2 = s2[np.argwhere((t2 >= min(t1)) & (t2 <= max(t1))).flatten()]
+n = t1.size
 
 
 
-# I. Continuous wavelet transform
-# ===============================
 
 
+# I. Wavelet transforms, cross-wavelet transform and coherence
+# ============================================================
 
-# Calculate the CWT of both normalized time series. The function wavelet.cwt
-# returns a a list with containing [wave, scales, freqs, coi, fft, fftfreqs]
-# variables.
-mother = wavelet.Morlet(6)          # Morlet mother wavelet with m=6
+''' Each (normalized) series is transformed only once, and the same two
+transforms give the wavelet power spectra, the cross wavelet transform
+(XWT), the phase and the wavelet coherence (WTC).
+The XWT finds regions in time frequency space where the time series
+show high common power. Torrence and Compo (1998) state that the
+percent point function -- PPF (inverse of the
+cumulative distribution function) -- of a chi-square distribution
+at 95% confidence and two degrees of freedom is Z2(95%)=3.999.
+However, calculating the PPF using chi2.ppf gives Z2(95%)=5.991.
+To ensure similar significance intervals as in Grinsted et al. (2004),
+one has to use confidence of 86.46%.
+The WTC finds regions in time frequency space where the
+two time seris co-vary, but do not necessarily have high power. '''
+mother = 'MORLET'                   # Morlet mother wavelet with k0=6
 slevel = 0.95                       # Significance level
 dj = 1/12                           # Twelve sub-octaves per octaves
-s0 =  2 * dt                   # Starting scale, here 6 months
-J = 6 / dj                    # Seven powers of two with dj sub-octaves
-if True:
-    alpha1, _, _ = wavelet.ar1(s1)  # Lag-1 autocorrelation for red noise
-    alpha2, _, _ = wavelet.ar1(s2)  # Lag-1 autocorrelation for red noise
-else:
-    alpha1 = alpha2 = 0.0           # Lag-1 autocorrelation for white noise
-
 
+wtc = coherence(s1, s2, dt, dj=dj, mother=mother, siglvl=0.8646,
+                xwt_siglvl=0.8646, cache=True)
+alpha1, alpha2 = wtc['lag1']        # Lag-1 autocorrelation for red noise
+scales = wtc['scale']
 
-# The following routines perform the wavelet transform and siginificance
-# analysis for two data sets.
-
-mother = 'morlet' 
-
-W1, scales1, freqs1, coi1, _, _ = wavelet.cwt(s1/std1, dt, dj, s0, J, mother)
-signif1, fft_theor1 = wavelet.significance(1.0, dt, scales1, 0, alpha1,
-                                           significance_level=slevel,
-                                           wavelet=mother)
-W2, scales2, freqs2, coi2, _, _ = wavelet.cwt(s2/std2, dt, dj, s0, J, mother)
-signif2, fft_theor2 = wavelet.significance(1.0, dt, scales2, 0, alpha2,
-                                           significance_level=slevel,
-                                           wavelet=mother)
-
-power1 = (np.abs(W1)) ** 2             # Normalized wavelet power spectrum
-power2 = (np.abs(W2)) ** 2             # Normalized wavelet power spectrum
 
 
+##--- wavelet power spectra and significance of each series
+signif1 = wave_signif(1.0, dt, scales, 0, alpha1, slevel, mother=mother)
+signif2 = wave_signif(1.0, dt, scales, 0, alpha2, slevel, mother=mother)
 
 ##--- RECTIFICATION OF BIAS (Liu et al, 2007; Veleda et al (2012))
-powers1      =   np.zeros_like(power1)
-for k in range(len(scales1)):
-    powers1[k,:] = power1[k,:] / np.sqrt(scales1[k])
-
-power1 = powers1
-
-
-powers2      =   np.zeros_like(power1)
-for k in range(len(scales2)):
-    powers2[k,:] = power2[k,:] / np.sqrt(scales2[k])
-
-power2 = powers2
-
+power1 = wtc['power1'] / np.sqrt(scales)[:, None]
+power2 = wtc['power2'] / np.sqrt(scales)[:, None]
 
-
-period1 = 1/freqs1
-period2 = 1/freqs2
-sig95_1 = np.ones([1, n1]) * signif1[:, None]
+period1 = period2 = wtc['period']
+sig95_1 = np.ones([1, n]) * signif1[:, None]
 sig95_1 = power1 / sig95_1             # Where ratio > 1, power is significant
-sig95_2 = np.ones([1, n2]) * signif2[:, None]
+sig95_2 = np.ones([1, n]) * signif2[:, None]
 sig95_2 = power2 / sig95_2             # Where ratio > 1, power is significant
 
 
 
-
-
-# II. Cross-wavelet transform
-# ===========================
-
-# Due to the difference in the time series, the second signal 
-# has to be trimmed for the XWT process.
-s2 = s2[np.argwhere((t2 >= min(t1)) & (t2 <= max(t1))).flatten()]
-
-''' Calculate the cross wavelet transform (XWT). 
-The XWT finds regions in time frequency space where the time series
-show high common power. Torrence and Compo (1998) state that the 
-percent point function -- PPF (inverse of the 
-cumulative distribution function) -- of a chi-square distribution 
-at 95% confidence and two degrees of freedom is Z2(95%)=3.999. 
-However, calculating the PPF using chi2.ppf gives Z2(95%)=5.991. 
-To ensure similar significance intervals as in Grinsted et al. (2004),
-one has to use confidence of 86.46%. '''
-W12, cross_coi, freq, signif = wavelet.xwt(s1, s2, dt,
-                                           dj=1/12, s0=-1, J=-1,
-                                           significance_level=0.8646,
-                                           wavelet='morlet',
-                                           normalize=True)
-
-cross_power = np.abs(W12)**2
-cross_sig = np.ones([1, n]) * signif[:, None]
+##--- cross-wavelet power
+cross_power = wtc['xwt_power']**2
+cross_sig = np.ones([1, n]) * wtc['xwt_signif'][:, None]
 cross_sig = cross_power / cross_sig  # Power is significant where ratio > 1
-cross_period = 1/freq
+cross_period = wtc['period']
+cross_coi = wtc['coi']
 
 
 
-'''Calculate the wavelet coherence (WTC).
-The WTC finds regions in time frequency space where the
-two time seris co-vary, but do not necessarily have high power.'''
-WCT, aWCT, corr_coi, freq, sig = wavelet.wct(s1, s2, dt,
-                                             dj=1/12, s0=-1, J=-1,
-                                             significance_level=0.8646,
-                                             wavelet='morlet', normalize=True,
-                                             cache=True)
-
-cor_sig = np.ones([1, n]) * sig[:, None]
+##--- wavelet coherence
+WCT = wtc['wct']
+cor_sig = np.ones([1, n]) * wtc['wct_signif'][:, None]
 cor_sig = np.abs(WCT) / cor_sig  # Power is significant where ratio > 1
-cor_period = 1 / freq
+cor_period = wtc['period']
+corr_coi = wtc['coi']
 
 
 
-''' Calculates the phase between both time series. 
+''' Calculates the phase between both time series.
 The phase arrows in the cross wavelet power spectrum rotate clockwise
 with 'north' origin.
 The relative phase relationship convention is the same as adopted
@@ -199,13 +146,8 @@ upwards (N), anti-phase signals point downwards (S). If X leads Y,
 arrows point to the right (E) and if X lags Y, arrow points to the
 left (W). '''
 
-angle = 0.5 * np.pi - aWCT
+angle = 0.5 * np.pi - wtc['phase']
 u, v = np.cos(angle), np.sin(angle)
-
-
-
-
-
 ##----------------------- PLOTTING
 
 
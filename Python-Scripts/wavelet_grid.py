@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+
+'''
+ File Name: wavelet_grid.py
+ Description: Wavelet analysis of gridded fields, one time series per grid point.
+ Observations: Your input data must be a xarray DataArray with a time dimension,
+ e.g. a (time, lat, lon) anomaly cube from a netcdf file. Points with missing
+ values (land) are skipped. The field is read in chunks of grid points and each
+ chunk goes through the cached WaveletPlan of waveletFunctions.py, optionally
+ on several cores, so memory stays bounded by the chunk size.
+ Author: Willy Hagi
+ E-mail: hagi.willy@gmail.com
+ Python Version: 3.7.3
+'''
+
+
+import numpy               as np
+import xarray              as xr
+import netCDF4
+
+from collections           import deque
+from concurrent.futures    import ProcessPoolExecutor
+from waveletFunctions      import wavelet_plan, wavelet_reduce, wave_bandpass, wave_signif
+from waveletCoherence      import coherence_plan, smooth
+from functions             import grid_slabs
+
+
+
+
+
+##----------------------- CHUNKING
+
+
+def _slabs(data, mask, chunk):
+    # grid_slabs of a time-last field, restricted to 'mask' if given, with
+    # the valid points as a (points, time) matrix
+    for sl, valid, x in grid_slabs(data, chunk, axis=-1):
+        if mask is not None:
+            valid &= mask[sl].reshape(-1)
+        yield sl, valid, x[valid]
+
+
+def map_chunks(func, data, dim='time', chunk=4096, workers=1, args=(), mask=None):
+    '''
+    Applies func(points, *args) to every chunk of valid grid points of 'data',
+    where points is a (points, time) matrix, and yields (slab, valid, result).
+    'mask' is an optional boolean DataArray over the grid, True where points
+    should be used (e.g. ocean); points with missing values are always
+    skipped, as in functions.Nan_calc. With workers > 1 the chunks run in a
+    process pool, with at most two chunks per worker waiting in memory.
+    '''
+    data   =  data.transpose(..., dim)
+    if mask is not None:
+        mask = np.asarray(mask.transpose(*data.dims[:-1]).values, dtype=bool)
+    slabs  =  _slabs(data, mask, chunk)
+    if workers == 1:
+        for sl, valid, points in slabs:
+            yield sl, valid, func(points, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for sl, valid, points in slabs:
+            pending.append((sl, valid, pool.submit(func, points, *args)))
+            if len(pending) > 2 * workers:
+                sl0, valid0, future = pending.popleft()
+                yield sl0, valid0, future.result()
+        while pending:
+            sl0, valid0, future = pending.popleft()
+            yield sl0, valid0, future.result()
+
+
+def _fill(out, sl, valid, result):
+    # scatter one chunk of results back into the (grid..., extra) output
+    view = out[sl].reshape((-1,) + out.shape[len(out.shape) - result.ndim + 1:])
+    view[valid] = result
+    out[sl] = view.reshape(out[sl].shape)
+
+
+
+
+
+##----------------------- BAND-PASS RECONSTRUCTION
+
+
+def bandpass_field(data, dt, band=(2, 8), pad=1, dj=-1, s0=-1, J1=-1, mother=-1, param=-1,
+                   dim='time', chunk=4096, workers=1, path=None, mask=None):
+    '''
+    Wavelet band-pass reconstruction (Eq. 29, TC 1998) of every grid point of
+    'data', the gridded version of wave_filter.py. 'band' is the [S1, S2) range
+    of scales kept, e.g. (2, 8) years for ENSO with dt in years; the other
+    wavelet options are the ones of waveletFunctions.wavelet and 'mask' is
+    the one of map_chunks. Returns a DataArray like 'data' (NaN over land).
+    If 'path' is given, each chunk is written to that netcdf file as soon as
+    it is done, so only one chunk is in memory, and the returned DataArray
+    is the file opened lazily.
+    '''
+    grid   =  data.transpose(..., dim)
+    dtype  =  np.result_type(data.dtype, np.float32)
+    name   =  '{}_{:g}to{:g}'.format(data.name or 'var', band[0], band[1])
+    attrs  =  dict(data.attrs)
+    attrs['wavelet_band'] = 'scales {:g} to {:g} (Eq. 29, Torrence and Compo 1998)'.format(*band)
+    args   =  (dt, band, pad, dj, s0, J1, mother, param)
+    chunks =  map_chunks(_bandpass_points, data, dim, chunk, workers, args, mask)
+    if path is not None:
+        return _write_chunks(path, grid, data.dims, name, dtype, attrs, chunks)
+
+    out    =  np.full(grid.shape, np.nan, dtype=dtype)
+    for sl, valid, result in chunks:
+        _fill(out, sl, valid, result)
+    xn     =  xr.DataArray(out, coords=grid.coords, dims=grid.dims, name=name, attrs=attrs)
+    return xn.transpose(*data.dims)
+
+
+def _write_chunks(path, grid, dims, name, dtype, attrs, chunks):
+    # writes the results of map_chunks slab by slab to the variable 'name'
+    # (dimensions 'dims') of a new netcdf file with the coordinates of grid
+    xr.Dataset(coords=grid.coords).to_netcdf(path)
+    order  =  [grid.dims.index(d) for d in dims]
+    with netCDF4.Dataset(path, 'a') as nc:
+        for d in dims:
+            if d not in nc.dimensions:
+                nc.createDimension(d, grid.sizes[d])
+        var    =  nc.createVariable(name, dtype, dims, zlib=True, fill_value=dtype.type(np.nan))
+        var.setncatts(attrs)
+        for sl, valid, result in chunks:
+            block  =  np.full((sl.stop - sl.start,) + grid.shape[1:], np.nan, dtype=dtype)
+            _fill(block, slice(None), valid, result)
+            var[tuple(sl if d == grid.dims[0] else slice(None) for d in dims)] = block.transpose(order)
+    return xr.open_dataarray(path)
+
+
+def _bandpass_points(points, dt, band, pad, dj, s0, J1, mother, param):
+    return wave_bandpass(points, dt, band, pad, dj, s0, J1, mother, param)
+
+
+
+
+
+##----------------------- SPECTRA AND VARIANCE MAPS
+
+
+def spectra_field(data, dt, bands=((2, 8),), siglvl=0.95, pad=1, dj=-1, s0=-1, J1=-1, mother=-1,
+                  param=-1, dim='time', chunk=4096, workers=1, mask=None):
+    '''
+    Wavelet variance maps of 'data', without a Python loop over the points:
+
+      global_ws     Global Wavelet Spectrum of every point (.., period)
+      global_sig    True where global_ws is above the 'siglvl' red-noise
+                    level (time-averaged test, dof = N - scale)
+      band_var      time-mean of the scale-averaged variance (Eq. 24) for
+                    each [S1, S2) scale range of 'bands' (band, ..)
+      peak_period   period of the maximum of the bias-rectified global
+                    spectrum (Liu et al. 2007)
+      lag1          lag-1 autocorrelation used for the red-noise background
+
+    The other options are the ones of bandpass_field.
+    '''
+    grid    =  data.transpose(..., dim)
+    shape   =  grid.shape[:-1]
+    bands   =  [tuple(b) for b in bands]
+    plan    =  wavelet_plan(grid.shape[-1], dt, pad, dj, s0, J1, mother, param)
+    period, scale = plan.period, plan.scale
+
+    out = dict(global_ws   = np.full(shape + (len(scale),), np.nan),
+               global_sig  = np.zeros(shape + (len(scale),), dtype=bool),
+               band_var    = np.full(shape + (len(bands),), np.nan),
+               peak_period = np.full(shape, np.nan),
+               lag1        = np.full(shape, np.nan))
+    args = (dt, bands, siglvl, pad, dj, s0, J1, mother, param)
+    for sl, valid, result in map_chunks(_spectra_points, data, dim, chunk, workers, args, mask):
+        for key in out:
+            _fill(out[key], sl, valid, result[key])
+
+    gdims  =  grid.dims[:-1]
+    coords =  {d: grid[d] for d in gdims if d in grid.coords}
+    band   =  ['{:g}-{:g}'.format(*b) for b in bands]
+    dset   =  xr.Dataset(dict(global_ws   = (gdims + ('period',), out['global_ws']),
+                              global_sig  = (gdims + ('period',), out['global_sig']),
+                              band_var    = (gdims + ('band',),   out['band_var']),
+                              peak_period = (gdims,               out['peak_period']),
+                              lag1        = (gdims,               out['lag1'])),
+                         coords=dict(coords, period=period, band=band))
+    dset['band_var'] = dset['band_var'].transpose('band', ...)
+    return dset
+
+
+def _spectra_points(points, dt, bands, siglvl, pad, dj, s0, J1, mother, param):
+    n        =  points.shape[-1]
+    red, period, scale, coi = wavelet_reduce(points, dt, pad, dj, s0, J1, mother, param, bands)
+    x        =  points - points.mean(axis=-1, keepdims=True)
+    variance =  np.mean(x ** 2, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lag1 =  np.sum(x[:, 1:] * x[:, :-1], axis=-1) / np.sum(x ** 2, axis=-1)
+    lag1     =  np.nan_to_num(lag1)
+    signif   =  wave_signif(1.0, dt, scale, 1, lag1, siglvl, n - scale, mother, param)
+    return dict(global_ws   = red['global_ws'],
+                global_sig  = red['global_ws'] > variance[:, np.newaxis] * signif,
+                band_var    = red['scale_avg'].mean(axis=-1),
+                peak_period = period[np.argmax(red['global_ws_rect'], axis=-1)],
+                lag1        = lag1)
+
+
+
+
+
+##----------------------- COHERENCE MAPS
+
+
+def coherence_field(index, data, dt, bands=((2, 8),), pad=1, dj=-1, s0=-1, J1=-1, mother='MORLET',
+                    param=-1, dim='time', chunk=512, workers=1, mask=None):
+    '''
+    Wavelet coherence between one index (e.g. the AO of Data/jao.txt) and every
+    grid point of 'data', on the same time axis. The index is transformed and
+    smoothed once; the field goes through map_chunks. For each [S1, S2) scale
+    range of 'bands', averaged over the band and over time outside the COI:
+
+      coherence   squared wavelet coherence (Grinsted et al. 2004)
+      phase       circular mean of the phase of the cross-wavelet transform,
+                  in radians (positive when the index leads)
+      xwt_power   cross-wavelet power |W12| of the normalized series
+
+    Scales follow the defaults of waveletCoherence.coherence. Each chunk holds
+    a few complex (points, scale, time) arrays, hence the smaller default
+    chunk; the other options are the ones of bandpass_field.
+    '''
+    grid    =  data.transpose(..., dim)
+    shape   =  grid.shape[:-1]
+    index   =  np.asarray(index, dtype=float)
+    if index.shape != grid.shape[-1:]:
+        raise ValueError('The index must have the length of the time dimension of the field')
+
+    plan    =  coherence_plan(len(index), dt, dj, s0, J1, mother, param, pad)
+    setup   =  (len(index), dt, plan.dj, plan.s0, plan.J1, mother, param, pad)
+    Wi      =  plan.transform((index - index.mean()) / index.std())
+    Si      =  smooth(np.abs(Wi) ** 2 / plan.scale[:, np.newaxis], dt, plan.dj, plan.scale, mother, param)
+    outside =  plan.period[:, np.newaxis] <= plan.coi[np.newaxis, :]
+    bands   =  [tuple(b) for b in bands]
+    weights =  np.stack([outside & ((plan.scale >= b[0]) & (plan.scale < b[1]))[:, np.newaxis]
+                         for b in bands]).astype(float)
+
+    out     =  {key: np.full(shape + (len(bands),), np.nan) for key in ('coherence', 'phase', 'xwt_power')}
+    args    =  (Wi, Si, weights, setup)
+    for sl, valid, result in map_chunks(_coherence_points, data, dim, chunk, workers, args, mask):
+        for key in out:
+            _fill(out[key], sl, valid, result[key])
+
+    gdims   =  grid.dims[:-1]
+    coords  =  {d: grid[d] for d in gdims if d in grid.coords}
+    band    =  ['{:g}-{:g}'.format(*b) for b in bands]
+    dset    =  xr.Dataset({key: (gdims + ('band',), out[key]) for key in out},
+                          coords=dict(coords, band=band))
+    dset    =  dset.transpose('band', ...)
+    dset['phase'].attrs['units'] = 'radians'
+    return dset
+
+
+def _coherence_points(points, Wi, Si, weights, setup):
+    n, dt, dj, s0, J1, mother, param, pad = setup
+    plan    =  coherence_plan(n, dt, dj, s0, J1, mother, param, pad)
+    scales  =  plan.scale[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x   =  points - points.mean(axis=-1, keepdims=True)
+        x   =  x / x.std(axis=-1, keepdims=True)
+        W   =  plan.transform(np.nan_to_num(x))
+        W12 =  Wi * W.conj()
+        S   =  smooth(np.abs(W) ** 2 / scales, dt, dj, plan.scale, mother, param)
+        S12 =  smooth(W12 / scales, dt, dj, plan.scale, mother, param)
+        R2  =  np.abs(S12) ** 2 / (Si * S)
+        U   =  W12 / np.abs(W12)
+    del W, S, S12
+
+    def band_mean(A):
+        # mean over the scales of each band and the times outside the COI
+        return np.einsum('pst,bst->pb', A, weights) / weights.sum(axis=(-2, -1))
+
+    return dict(coherence = band_mean(R2),
+                phase     = np.angle(band_mean(U.real) + 1j * band_mean(U.imag)),
+                xwt_power = band_mean(np.abs(W12)))